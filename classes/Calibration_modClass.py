@@ -0,0 +1,298 @@
+"""Калибровка индуктивности проводов и эффективной массы по измеренным осциллограммам тока"""
+from classes.ShotClass import Shot
+import csv
+import itertools
+import os
+import warnings
+import numpy as np
+import scipy.integrate as spint
+import scipy.stats as spstats
+
+
+class Calibration_mod:
+    def __init__(self, *args, **kwargs):
+        self.mShot = None
+        """Опорный выстрел (сетка времени и начальное приближение)"""
+        self.mFiles = None
+        """Файлы с осциллограммами тока (CSV или NPZ)"""
+        self.mBatch_size = None
+        """Количество осциллограмм, подгоняемых одновременно"""
+        self.mMax_iter = None
+        """Максимальное число итераций Левенберга-Марквардта"""
+        self.mTolerance = None
+        """Относительный шаг по параметрам, при котором подгонка завершается"""
+        self.mConfidence = None
+        """Доверительная вероятность"""
+        self.mBounds = None
+        """Допустимое отклонение L0 и M от начального приближения (во сколько раз)"""
+        self.mResidual_max = None
+        """Наибольшая допустимая относительная СКО невязки"""
+        self.mTable = None
+        """Таблица подогнанных параметров"""
+        try:
+            self.init_full(*args, **kwargs)
+        except KeyError:
+            self.init_default()
+
+    def init_full(self, *args, **kwargs):
+        """Полная инициализация"""
+        self.mFiles = list(kwargs['Files'])
+        self.mBatch_size = kwargs['Batch_size']
+        self.mMax_iter = kwargs['Max_iter']
+        self.mTolerance = kwargs['Tolerance']
+        self.mConfidence = kwargs['Confidence']
+        self.mBounds = kwargs.get('Bounds', 100.0)
+        self.mResidual_max = kwargs.get('Residual_max', 0.1)
+        self.mShot = Shot(**kwargs)
+        self.prepare_data()
+        self.find_solution()
+
+    def init_default(self):
+        """Инициализация по умолчанию"""
+        self.mFiles = []
+        self.mBatch_size = 64
+        self.mMax_iter = 50
+        self.mTolerance = 1.0e-6
+        self.mConfidence = 0.95
+        self.mBounds = 100.0
+        self.mResidual_max = 0.1
+        self.mShot = Shot()
+        self.prepare_data()
+        self.find_solution()
+
+    def prepare_data(self):
+        """Подготовка данных к подгонке"""
+        self.mTime = self.mShot.mTime
+        self.mInitial_solution = np.array(self.mShot.mInitial_solution, dtype=float)
+        self.mL0_guess = self.mShot.mL0
+        self.mM_guess = self.mShot.mM_gas
+        self.mQ_mult = np.power(self.mShot.mL_linear * self.mShot.mCapacity * self.mShot.mU0, 2) / 2.0
+        """Q_gun = mQ_mult / (M * L0)"""
+
+    def load_records(self, files):
+        """Потоковое чтение осциллограмм с передискретизацией на сетку времени выстрела.
+        CSV: столбцы время, ток. NPZ: массивы 'time' и 'current'.
+        Ошибка чтения файла возвращается третьим элементом вместо осциллограммы."""
+        for file in files:
+            try:
+                if os.path.splitext(file)[1].lower() == '.npz':
+                    with np.load(file) as data:
+                        time = np.asarray(data['time'], dtype=float)
+                        current = np.asarray(data['current'], dtype=float)
+                else:
+                    data = np.loadtxt(file, delimiter=',', comments='#', ndmin=2)
+                    time = data[:, 0]
+                    current = data[:, 1]
+                order = np.argsort(time)
+                resampled = np.interp(self.mTime, time[order], current[order], left=np.nan, right=np.nan)
+            except (OSError, ValueError, KeyError, IndexError) as error:
+                yield file, None, 'error: %s' % error
+            else:
+                yield file, resampled, None
+
+    def model(self, theta):
+        """Ток и его производные по ln(L0), ln(M) для набора параметров theta (N, 2).
+        Интегрирование в реальном времени, чтобы у всех записей была общая сетка;
+        уравнения чувствительности решаются вместе с основными.
+        Третий элемент - признак успешного интегрирования всего пакета."""
+        count = theta.shape[0]
+        with np.errstate(all='ignore'):
+            L0 = np.exp(theta[:, 0])
+            M = np.exp(theta[:, 1])
+            omega_0 = 1.0 / np.sqrt(L0 * self.mShot.mCapacity)
+            Q_gun = self.mQ_mult / (M * L0)
+
+        def WorkEquation(z, t):
+            z = z.reshape(count, 12)
+            y = z[:, 0:4]
+            s_L = z[:, 4:8]
+            s_M = z[:, 8:12]
+            mass = 1.0 + y[:, 1]
+            g = np.stack([
+                Q_gun * y[:, 3] ** 2,
+                y[:, 0],
+                -y[:, 3],
+                (y[:, 2] - y[:, 0] * y[:, 3]) / mass
+            ], axis=1)
+
+            def jacobian_dot(s):
+                return np.stack([
+                    2.0 * Q_gun * y[:, 3] * s[:, 3],
+                    s[:, 0],
+                    -s[:, 3],
+                    (-y[:, 3] * s[:, 0] - g[:, 3] * s[:, 1] + s[:, 2] - y[:, 0] * s[:, 3]) / mass
+                ], axis=1)
+
+            # dg/dQ * dQ/dln(M) = dg/dQ * dQ/dln(L0) = -Q dg/dQ
+            dg_dlnQ = np.zeros_like(g)
+            dg_dlnQ[:, 0] = g[:, 0]
+            ds_L = jacobian_dot(s_L) - 0.5 * g - dg_dlnQ
+            ds_M = jacobian_dot(s_M) - dg_dlnQ
+            ret = np.concatenate([g, ds_L, ds_M], axis=1) * omega_0[:, None]
+            return ret.ravel()
+
+        z0 = np.zeros((count, 12))
+        z0[:, 0:4] = self.mInitial_solution
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter('ignore', spint.ODEintWarning)
+            Solution, info = spint.odeint(WorkEquation, z0.ravel(), self.mTime, full_output=True)
+        success = info['message'] == 'Integration successful.' and np.all(np.isfinite(Solution))
+        Solution = Solution.reshape(len(self.mTime), count, 12)
+        Current_mult = self.mShot.mCapacity * self.mShot.mU0 * omega_0
+        with np.errstate(all='ignore'):
+            current = (Solution[:, :, 3] * Current_mult).T
+            jacobian = np.stack([
+                -0.5 * current + (Solution[:, :, 7] * Current_mult).T,
+                (Solution[:, :, 11] * Current_mult).T
+            ], axis=2)
+        success = success and np.all(np.isfinite(jacobian))
+        return current, jacobian, success
+
+    def fit_batch(self, current_meas):
+        """Пакетная подгонка методом Левенберга-Марквардта, current_meas (N, T).
+        Возвращает параметры ln(L0), ln(M), полуширину доверительного интервала,
+        относительную СКО невязки (доля от максимума |I| записи) и статус подгонки:
+        'converged', 'out_of_range' (параметры дальше mBounds от начального приближения),
+        'unidentifiable' (вырожденная матрица J^T J), 'poor_fit' (невязка больше mResidual_max),
+        'stalled' (демпфирование выросло без уменьшения невязки), 'max_iter',
+        'ode_failed' (интегрирование не удалось) или 'no_data' (меньше 3 точек на сетке времени)."""
+        count = current_meas.shape[0]
+        theta = np.full((count, 2), np.nan)
+        half_width = np.full((count, 2), np.nan)
+        rms = np.full(count, np.nan)
+        status = np.full(count, 'no_data', dtype=object)
+        samples = np.sum(np.isfinite(current_meas), axis=1)
+        good = samples >= 3
+        if not np.any(good):
+            return theta, half_width, rms, status
+        current_meas = current_meas[good]
+        count = current_meas.shape[0]
+        weight = np.isfinite(current_meas).astype(float)
+        current_meas = np.nan_to_num(current_meas)
+        scale = np.max(np.abs(current_meas), axis=1)
+        scale[scale == 0.0] = 1.0
+        weight = weight / scale[:, None]
+
+        def residual(theta, index):
+            """Невязка записей index; если пакет не проинтегрировался,
+            записи считаются по одной, чтобы сбой одной не портил остальные."""
+            r = np.full((len(index), current_meas.shape[1]), np.nan)
+            J = np.full((len(index), current_meas.shape[1], 2), np.nan)
+            cost = np.full(len(index), np.inf)
+            current, jacobian, success = self.model(theta)
+            if success:
+                parts = [(np.arange(len(index)), current, jacobian)]
+            else:
+                parts = []
+                for k in range(len(index)):
+                    current, jacobian, success = self.model(theta[k:k + 1])
+                    if success:
+                        parts.append(([k], current, jacobian))
+            for rows, current, jacobian in parts:
+                r[rows] = (current - current_meas[index[rows]]) * weight[index[rows]]
+                J[rows] = jacobian * weight[index[rows], :, None]
+                cost[rows] = np.sum(r[rows] ** 2, axis=1)
+            return r, J, cost
+
+        theta_guess = np.log([self.mL0_guess, self.mM_guess])
+        theta_fit = np.tile(theta_guess, (count, 1))
+        lam = np.full(count, 1.0e-3)
+        converged = np.zeros(count, dtype=bool)
+        stalled = np.zeros(count, dtype=bool)
+        out_of_range = np.zeros(count, dtype=bool)
+        r, J, cost = residual(theta_fit, np.arange(count))
+        failed = ~np.isfinite(cost)
+        for i in range(self.mMax_iter):
+            active = np.nonzero(~(converged | stalled | failed | out_of_range))[0]
+            if len(active) == 0:
+                break
+            A = np.einsum('nti,ntj->nij', J[active], J[active])
+            grad = np.einsum('nti,nt->ni', J[active], r[active])
+            # Шаг Гаусса-Ньютона меньше допуска - точка стационарна, даже если
+            # пробный шаг отвергнут из-за погрешности интегрирования
+            step_gn = -np.einsum('nij,nj->ni', np.linalg.pinv(A), grad)
+            settled = np.max(np.abs(step_gn), axis=1) < self.mTolerance
+            converged[active[settled]] = True
+            active = active[~settled]
+            if len(active) == 0:
+                break
+            A = A[~settled]
+            grad = grad[~settled]
+            A_damped = A + lam[active, None, None] * (A * np.eye(2) + 1.0e-12 * np.eye(2))
+            step = -np.linalg.solve(A_damped, grad[:, :, None])[:, :, 0]
+            r_new, J_new, cost_new = residual(theta_fit[active] + step, active)
+            accept = cost_new < cost[active]
+            index = active[accept]
+            theta_fit[index] += step[accept]
+            r[index] = r_new[accept]
+            J[index] = J_new[accept]
+            cost[index] = cost_new[accept]
+            # Шаг меньше допуска завершает подгонку и когда он отвергнут: изменение
+            # невязки на таком шаге ниже погрешности интегрирования
+            converged[active[np.max(np.abs(step), axis=1) < self.mTolerance]] = True
+            lam[active] = np.where(accept, lam[active] / 10.0, lam[active] * 10.0)
+            stalled |= ~converged & (lam > 1.0e10)
+            # Физически недопустимые значения: запись снимается с подгонки
+            out_of_range[index] = np.any(np.abs(theta_fit[index] - theta_guess) > np.log(self.mBounds), axis=1)
+
+        dof = samples[good] - 2
+        variance = cost / dof
+        covariance = np.full((count, 2, 2), np.nan)
+        singular = np.ones(count, dtype=bool)
+        fitted = np.nonzero(~failed)[0]
+        if len(fitted):
+            A = np.einsum('nti,ntj->nij', J[fitted], J[fitted])
+            regular = fitted[np.linalg.cond(A) < 1.0e12]
+            covariance[regular] = np.linalg.inv(A[np.isin(fitted, regular)]) * variance[regular, None, None]
+            singular[regular] = False
+        with np.errstate(invalid='ignore'):
+            sigma = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+        fit_status = np.where(converged, 'converged', np.where(stalled, 'stalled', 'max_iter')).astype(object)
+        fit_status[np.sqrt(variance) > self.mResidual_max] = 'poor_fit'
+        fit_status[singular] = 'unidentifiable'
+        fit_status[out_of_range] = 'out_of_range'
+        fit_status[failed] = 'ode_failed'
+        theta_fit[failed] = np.nan
+        theta[good] = theta_fit
+        half_width[good] = spstats.t.ppf(0.5 + self.mConfidence / 2.0, dof)[:, None] * sigma
+        rms[good] = np.sqrt(variance)
+        status[good] = fit_status
+        return theta, half_width, rms, status
+
+    def find_solution(self):
+        """Подгонка всех файлов пакетами по mBatch_size записей, строки таблицы в порядке mFiles.
+        Residual_rel - СКО невязки, отнесенная к максимуму |I| записи (безразмерная)."""
+        dtype = [
+            ('File', object),
+            ('L0', float), ('L0_low', float), ('L0_high', float),
+            ('M_gas', float), ('M_gas_low', float), ('M_gas_high', float),
+            ('Q_gun', float), ('Residual_rel', float), ('Converged', bool), ('Status', object)
+        ]
+        rows = []
+        records = self.load_records(self.mFiles)
+        while True:
+            batch = list(itertools.islice(records, self.mBatch_size))
+            if not batch:
+                break
+            batch_rows = [(name,) + (np.nan,) * 8 + (False, error) for name, current, error in batch]
+            loaded = [k for k in range(len(batch)) if batch[k][2] is None]
+            if loaded:
+                theta, half_width, rms, status = self.fit_batch(np.array([batch[k][1] for k in loaded]))
+                L0 = np.exp(theta[:, 0])
+                M = np.exp(theta[:, 1])
+                low = np.exp(theta - half_width)
+                high = np.exp(theta + half_width)
+                Q_gun = self.mQ_mult / (M * L0)
+                for j, k in enumerate(loaded):
+                    batch_rows[k] = (batch[k][0], L0[j], low[j, 0], high[j, 0], M[j], low[j, 1], high[j, 1],
+                                     Q_gun[j], rms[j], status[j] == 'converged', status[j])
+            rows.extend(batch_rows)
+        self.mTable = np.array(rows, dtype=dtype)
+
+    def save(self, file):
+        """Сохранение таблицы параметров в CSV"""
+        with open(file, 'w', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(self.mTable.dtype.names)
+            for row in self.mTable:
+                writer.writerow(row.tolist())
@@ -29,4 +29,10 @@ from classes.Capasity_modClass import Capacity_mod
 new_Capacity_mod = Capacity_mod()
 new_Capacity_mod.plot()
 
+#from classes.Calibration_modClass import Calibration_mod
+
+#new_Calibration_mod = Calibration_mod(Files=["shot_001.csv", "shot_002.npz"], Batch_size=64, Max_iter=50,
+#                                      Tolerance=1.0e-6, Confidence=0.95)
+#new_Calibration_mod.save("calibration.csv")
+
 # See PyCharm help at https://www.jetbrains.com/help/pycharm/